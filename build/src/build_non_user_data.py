@@ -1,15 +1,21 @@
 import argparse
 import collections
+import concurrent.futures
+import functools
+import hashlib
 import json
 import logging
 import os
 import pathlib
 import re
+import sys
 from datetime import date
 
+import ijson
 import midi
+import orjson
 
-from tqdm.contrib.concurrent import process_map
+from tqdm import tqdm
 
 logging.basicConfig(level=logging.DEBUG,
                     format='[%(name)s:%(lineno)s] %(message)s')
@@ -17,7 +23,12 @@ log = logging.getLogger(os.path.basename(__file__))
 
 STOP_WORDS = {"a", "an", "the", "at", "by", "for", "in", "of", "on",
               "to", "up", "and", "as", "but", "or", "nor"}
-NON_WORD_CHARS = re.compile('[^a-zA-Z ]')
+NON_WORD_CHARS = re.compile('[^a-z ]+')
+ABC_STRIP_CHARS = re.compile(r'[\\\r]+')
+MAX_CHUNKSIZE = 32
+
+# Set in each worker process by init_worker
+MIDIS_DIR = None
 
 
 def build_non_user_data(parent_dir):
@@ -33,9 +44,6 @@ def build_non_user_data(parent_dir):
     midis_dir = os.path.join(data_dir, 'midis')
     pathlib.Path(midis_dir).mkdir(parents=True, exist_ok=True)
 
-    with open(tunes_path, 'r') as f:
-        thesession_data = json.load(f)
-
     with open(aliases_path, 'r') as f:
         thesession_aliases = json.load(f)
 
@@ -57,36 +65,70 @@ def build_non_user_data(parent_dir):
     #   once. We store this with the aliases, because that's where the names
     #   of tunes are kept.
 
-    log.info('Gathering tune name aliases')
-    gathered_aliases = gather_aliases(thesession_aliases, thesession_data)
-
-    log.info('Creating cleaned version of input data file')
-    cleaned_thesession_data = clean_thesession_data(thesession_data)
-
-    multiprocessing_input = [(setting, midis_dir)
-                             for setting in cleaned_thesession_data]
-
-    # The heavy lifting is done here
-    contours = process_map(
-        generate_midi_contour,
-        multiprocessing_input,
-        desc='Converting ABC text to contour string',
-        chunksize=8)
-
-    # Convert settings/contours into one dictionary of setting_id: setting
-    settings = {}
-
-    for setting in cleaned_thesession_data:
-        settings[setting['setting_id']] = setting
-
+    # The input data file is streamed so that only the cleaned settings,
+    #   already collected into one dictionary of setting_id: setting, are
+    #   ever held in memory.
+    log.info('Reading cleaned settings from input data file')
+    tune_names = {}
+    settings = {
         # Key doesn't need to be also stored on value
-        del settings[setting['setting_id']]['setting_id']
+        setting.pop('setting_id'): setting
+        for setting in iter_settings(tunes_path, tune_names)
+    }
+
+    log.info('Gathering tune name aliases')
+    gathered_aliases = gather_aliases(thesession_aliases, tune_names)
+
+    # Cleaned aliases aren't needed again, so release them
+    clean_alias.cache_clear()
+
+    # Many settings are identical once their ABC has been normalised, even
+    #   though their metadata differs, so each distinct ABC text is only
+    #   converted once and its contour shared by all settings using it.
+    setting_ids_by_abc = collections.defaultdict(list)
+    for setting_id, setting in settings.items():
+        abc = setting_to_abc(setting['meter'], setting['mode'],
+                             setting['abc'])
+        setting_ids_by_abc[abc].append(setting_id)
+
+    # Aim for about four chunks per worker to limit pickling between
+    #   processes, but cap the size so that the progress bar stays smooth.
+    workers = os.cpu_count() or 1
+    chunksize = max(1, min(MAX_CHUNKSIZE,
+                           len(setting_ids_by_abc) // (workers * 4)))
+
+    abc_texts = list(setting_ids_by_abc)
+
+    # Compile the quantisation kernel here first, so that a failure stops
+    #   the build immediately with its own error, before any workers start.
+    init_worker(midis_dir)
+
+    # The heavy lifting is done here. If a worker dies mid-task the
+    #   executor raises BrokenProcessPool, failing the build, rather than
+    #   waiting forever for the lost result.
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(midis_dir,)) as executor:
+        contours = list(tqdm(
+            executor.map(generate_midi_contour, abc_texts,
+                         chunksize=chunksize),
+            desc='Converting ABC text to contour string',
+            total=len(abc_texts)))
+
+    # The full ABC texts are a second copy of most of the input data, so
+    #   release them before the output is assembled and written.
+    setting_id_groups = list(setting_ids_by_abc.values())
+    del abc_texts, setting_ids_by_abc
 
     # It's possible that a contour doesn't exist for some setting, but
     #   in that case we still want to keep the setting because it might
     #   be useful to have the sheet music even if it isn't queryable.
-    for setting_id, contour in contours:
-        settings[setting_id]['contour'] = contour
+    for setting_ids, contour in zip(setting_id_groups, contours):
+        for setting_id in setting_ids:
+            settings[setting_id]['contour'] = contour
+
+    del contours, setting_id_groups
 
     # Put everything together
     non_user_data = {
@@ -95,57 +137,67 @@ def build_non_user_data(parent_dir):
     }
 
     log.info(f'Writing {non_user_data_path}')
-    with open(non_user_data_path, 'w') as f:
-        json.dump(non_user_data, f)
+    with open(non_user_data_path, 'wb') as f:
+        f.write(orjson.dumps(non_user_data))
 
     build_nud_meta(non_user_data_path, non_user_metadata_path)
 
 
-def clean_thesession_data(tune_data):
-    # Convert types and discard redundant data
-    for i, _ in enumerate(tune_data):
-        del tune_data[i]['date']
-        del tune_data[i]['username']
-        del tune_data[i]['name']
-        # "type" is a common programming keyword, causes issues later.
-        tune_data[i]['dance'] = tune_data[i]['type']
-        del tune_data[i]['type']
+def iter_settings(tunes_path, tune_names):
+    """Stream settings from the tunes.json file, discarding redundant data.
 
-        # The keys are still stored as strings because that's all JSON can do.
-        #   We don't bother converting the tune_id to an int so that it can be
-        #   used as a key directly without worrying about parsing between int
-        #   and string.
+    The name of each tune is recorded once in tune_names, a dictionary of
+    tune_id: name, instead of being kept on every setting."""
 
-    return tune_data
+    with open(tunes_path, 'rb') as f:
+        for setting in ijson.items(f, 'item'):
+            tune_names.setdefault(setting['tune_id'], setting['name'])
 
+            # The keys are still stored as strings because that's all JSON
+            #   can do. We don't bother converting the tune_id to an int so
+            #   that it can be used as a key directly without worrying about
+            #   parsing between int and string.
+            # Meter, mode and dance only take a few dozen distinct values,
+            #   so these are interned to share one string object each.
+            yield {
+                'tune_id': setting['tune_id'],
+                'setting_id': setting['setting_id'],
+                'meter': sys.intern(setting['meter']),
+                'mode': sys.intern(setting['mode']),
+                'abc': setting['abc'],
+                # "type" is a common programming keyword, causes issues later.
+                'dance': sys.intern(setting['type']),
+            }
 
-def gather_aliases(alias_records, tune_data):
+
+def gather_aliases(alias_records, tune_names):
     # The aliases.json file is inefficiently structured for network
     #   distribution and we can condense it somewhat. We also merge
     #   the "name" field of each tune into aliases, so that all the
     #   names are stored in one place, and each name/alias is stored
     #   exactly once.
 
-    aliases = collections.defaultdict(list)
-
-    # Add aliases from alias data proper
-    for alias_record in sorted(alias_records, key=lambda r: int(r['tune_id'])):
+    # Add aliases from alias data proper. These are grouped by tune before
+    #   ordering by tune_id, so that the tune_ids are only parsed as ints
+    #   once per tune rather than once per alias record.
+    grouped_aliases = collections.defaultdict(list)
+    for alias_record in alias_records:
         tid = alias_record['tune_id']
         alias = alias_record['alias'].lower()
-        aliases[tid].append(alias)
+        grouped_aliases[tid].append(alias)
 
-    for tid in aliases:
-        aliases[tid] = deduplicate_aliases(aliases[tid])
+    aliases = collections.defaultdict(list)
+    for tid in sorted(grouped_aliases, key=int):
+        aliases[tid] = deduplicate_aliases(grouped_aliases[tid])
 
     # Add 'name' fields so that the first alias is always the 'name'
     #   on the session. This is usually the most common name for the
     #   tune, so we never de-dupe this and make sure it's always the
     #   first alias.
-    for i, _ in enumerate(tune_data):
-        tid = tune_data[i]['tune_id']
-        alias = tune_data[i]['name'].lower()
-        
-        # Tune name is identical accross settings to only add once per setting.
+    for tid, name in tune_names.items():
+        alias = name.lower()
+
+        # Tune name is identical accross settings so is only recorded once.
         if not aliases[tid] or aliases[tid][0] != alias:
             aliases[tid].insert(0, alias)
 
@@ -169,57 +221,81 @@ def deduplicate_aliases(aliases):
 
     deduped_aliases = sorted(deduped_aliases, key=lambda c: len(c[0]))
 
-    # Remove subsets. Requires sorting by length.
+    # Remove subsets. Requires sorting by length, so that only later (no
+    #   shorter) cleaned aliases can be supersets. These are all distinct
+    #   after de-duping, so any of them containing this one is a superset.
+    cleaned_aliases = [cleaned for (cleaned, _) in deduped_aliases]
     deduped_aliases_no_subsets = []
     for i, (cleaned, alias) in enumerate(deduped_aliases):
-        is_subset = (cleaned < c for (c, _) in deduped_aliases[i:])
-        if not any(is_subset):
+        for j in range(i + 1, len(cleaned_aliases)):
+            if cleaned.issubset(cleaned_aliases[j]):
+                break
+        else:
             deduped_aliases_no_subsets.append(alias)
 
     # Back to alphabetical at the end
     return sorted(deduped_aliases_no_subsets)
 
 
+@functools.lru_cache(maxsize=None)
 def clean_alias(alias):
-    # Remove redundancy from each string
-    alias = alias.lower()
-    alias = NON_WORD_CHARS.sub('', alias)
-    alias = alias.split()
-    alias = (w for w in alias if w and w not in STOP_WORDS)
-    alias = ((w[:-1] if w.endswith('s') else w)
-             for w in alias)  # Ignore plurals
+    # Remove redundancy from each string. Many aliases recur verbatim
+    #   across tunes, so results are cached.
+    cleaned = set()
+
+    for w in NON_WORD_CHARS.sub('', alias.lower()).split():
+        if w in STOP_WORDS:
+            continue
+
+        # Ignore plurals
+        if w.endswith('s'):
+            w = w[:-1]
 
-    # This American spelling pops up a lot. Retain the British spelling
-    #   for alias purposes.
-    alias = ((w if not w == 'favorite' else 'favourite') for w in alias)
-    return frozenset(sorted(alias))
+        # This American spelling pops up a lot. Retain the British spelling
+        #   for alias purposes.
+        if w == 'favorite':
+            w = 'favourite'
 
+        cleaned.add(w)
 
-def generate_midi_contour(args):
-    setting, midis_path = args
+    return frozenset(cleaned)
 
+
+def setting_to_abc(meter, mode, abc):
+    """Build the full ABC text of a setting, as passed to abc2midi."""
     abc_header = [
         'X:1',
         'T:',
-        f'M:{setting["meter"].strip()}',
+        f'M:{meter.strip()}',
         'L:1/8',
-        f'K:{setting["mode"].strip()}'
+        f'K:{mode.strip()}'
     ]
-    abc_body = setting['abc'].replace(
-        '\\', '').replace(
-        '\r', '').split('\n')
-    abc = '\n'.join(abc_header + abc_body)
+    abc_body = ABC_STRIP_CHARS.sub('', abc)
+    return '\n'.join(abc_header) + '\n' + abc_body
+
+
+def init_worker(midis_dir):
+    global MIDIS_DIR
+    MIDIS_DIR = midis_dir
 
-    midi_out_path = os.path.join(midis_path,
-                                 f'{setting["setting_id"]}.midi')
+    # Compile (or load the cached) quantisation kernel once per process,
+    #   not on the first task. Also called in the parent before the pool
+    #   starts, so this can't be the first place it fails.
+    midi.MidiNoteReader(b'').to_midi_contour()
+
+
+def generate_midi_contour(abc):
+    # Midi files are named by a hash of their ABC text, so settings sharing
+    #   ABC share a file and an edited setting never reuses a stale one.
+    abc_hash = hashlib.sha1(abc.encode('utf-8')).hexdigest()
+    midi_out_path = os.path.join(MIDIS_DIR, f'{abc_hash}.midi')
 
     if not os.path.exists(midi_out_path):
         midi.abc_to_midi(abc, midi_out_path)
 
-    midi_events = midi.midi_as_csv(midi_out_path)
-    note_contour = midi.CSVMidiNoteReader(midi_events).to_midi_contour()
-
-    return setting['setting_id'], note_contour
+    with open(midi_out_path, 'rb') as f:
+        midi_bytes = f.read()
+    return midi.MidiNoteReader(midi_bytes).to_midi_contour()
 
 
 def build_nud_meta(nud_path, nud_meta_path):
@@ -233,8 +309,8 @@ def build_nud_meta(nud_path, nud_meta_path):
         'size': non_user_data_bytes
     }
 
-    with open(nud_meta_path, 'w') as f:
-        json.dump(nud_meta, f)
+    with open(nud_meta_path, 'wb') as f:
+        f.write(orjson.dumps(nud_meta))
 
 
 if __name__ == '__main__':
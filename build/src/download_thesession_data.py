@@ -9,16 +9,19 @@ log = logging.getLogger(os.path.basename(__file__))
 
 
 DATA_URL = 'https://raw.githubusercontent.com/adactio/TheSession-data/main/json/{}.json'
+DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 
 def download_data(parent_dir, data_type):
     data_url = DATA_URL.format(data_type)
     data_file_path = os.path.join(parent_dir, 'data', data_type + '.json')
 
-    r = requests.get(data_url)
-    with open(data_file_path, 'wb') as f:
+    # Stream to disk rather than holding the whole response in memory
+    with requests.get(data_url, stream=True) as r, \
+            open(data_file_path, 'wb') as f:
         log.info(f'Writing {data_file_path}')
-        f.write(r.content)
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
 
 
 if __name__ == '__main__':
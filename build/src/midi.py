@@ -1,56 +1,73 @@
-import csv
 import logging
 import math
 import os
 import subprocess
-import sys
+from array import array
+
+import numpy as np
+from numba import njit
 
-# import numpy as np
-import py_midicsv
 import ff_config
 
 logging.basicConfig(level=logging.DEBUG,
                     format='[%(name)s:%(lineno)s] %(message)s')
 log = logging.getLogger(os.path.basename(__file__))
 
+# numba logs every compilation step at DEBUG level
+logging.getLogger('numba').setLevel(logging.WARNING)
 
-class CSVMidiNoteReader(csv.DictReader):
-    # TODO re-work this class, it probably shouldn't subclass csv.DictReader
-    def __init__(self, *posargs, **kwargs):
-        kwargs['fieldnames'] = ['track', 'time', 'type', 'channel',
-                                'note', 'velocity']
-        super().__init__(*posargs, **kwargs)
-        self._notes = self.to_notes()
+# Translation table from relative pitch bytes to ff_config.MIDI_MAP letters
+MIDI_MAP_TABLE = ff_config.MIDI_MAP.encode('ascii').ljust(256, b'\0')
 
-    def to_notes(self):
-        """Convert these midi instructions to a list of Note objects"""
+DEFAULT_TEMPO = 125
 
-        active_notes = {}
-        notes = []
 
-        for record in self:
-            if not record['note'] or not record['note'].isdigit():
-                continue
-            note = int(record['note'])
-            time = int(record['time'])
+def ms_scale_factor(tempo):
+    """Factor scaling midi times to milliseconds at a tempo, in crotchet
+    beats per minute."""
 
-            if record['type'] == 'Note_on_c':
-                if note not in active_notes:
-                    active_notes[note] = time
-            elif record['type'] == 'Note_off_c':
-                if note not in active_notes:
-                    continue
+    us_per_crotchet = 60000000. / tempo
+
+    # Beware that abc2midi does not adjust tempo by changing the times at
+    #   which notes start or end, but by (sensibly) passing the tempo to
+    #   the midi file itself which has a command to set the tempo, which
+    #   must be interpreted by whatever reads the midi file (eg fluidsynth
+    #   and this script).
+
+    # This 480,000 comes from 125 bpm being the default tempo with the hard
+    #   coded midi times (240ms = 1 quaver => 480000us = 1 crotchet).
+    return us_per_crotchet / 480000
 
-                note_end = time
-                note_start = active_notes.pop(note)
 
-                notes.append(Note(start=note_start,
-                                  end=note_end,
-                                  pitch=note))
+def rel_pitch(pitch):
+    """Fold a midi pitch into the range above MIDI_LOW, relative to it."""
 
-        return notes
+    # We use LTE / GTE here because we need an amount of frequency
+    #   content on both sides of the relevant pitch bin. See
+    #   comment on inclusive range in to_pseudo_spectrogram.
+    while pitch <= ff_config.MIDI_LOW:
+        pitch += 12
 
-    def to_midi_contour(self, tempo=125, start_seconds=None, end_seconds=None):
+    while pitch >= ff_config.MIDI_HIGH:
+        pitch -= 12
+
+    return pitch - ff_config.MIDI_LOW
+
+
+# Relative pitch of every midi pitch, indexed by midi pitch
+REL_PITCH = np.array([rel_pitch(p) for p in range(128)], dtype=np.int8)
+
+# Remember default midi quaver duration is 240 ms (TODO always?)
+DEFAULT_MS_SCALE_FACTOR = ms_scale_factor(DEFAULT_TEMPO)
+DEFAULT_QUAVER_DURATION = DEFAULT_MS_SCALE_FACTOR * 240
+
+
+class MidiNoteReader:
+    def __init__(self, midi_bytes):
+        self._starts, self._ends, self._pitches = parse_midi_notes(midi_bytes)
+
+    def to_midi_contour(self, tempo=DEFAULT_TEMPO, start_seconds=None,
+                        end_seconds=None):
         """Quantise an arbitrary sequence of MIDI notes into all quavers.
 
         This results in some distortion of the melody but it should closely
@@ -59,101 +76,173 @@ class CSVMidiNoteReader(csv.DictReader):
         be relatively unaffected. Tune query searching with variable note
         durations would be a whole different kettle of fish."""
 
-        # TODO this NEEDS test cases as it's a pretty weird function.
-
-        midi_contour = []
-
-        music_time = 0
-        output_time = 0
+        if tempo == DEFAULT_TEMPO:
+            scale = DEFAULT_MS_SCALE_FACTOR
+            quaver_duration = DEFAULT_QUAVER_DURATION
+        else:
+            scale = ms_scale_factor(tempo)
+            quaver_duration = scale * 240
+
+        starts_ms = np.frombuffer(self._starts, dtype=np.int32) * scale
+        ends_ms = np.frombuffer(self._ends, dtype=np.int32) * scale
+        pitches = np.frombuffer(self._pitches, dtype=np.uint8)
+
+        midi_contour = quantise(
+            starts_ms, ends_ms, pitches, quaver_duration,
+            1000 * start_seconds if start_seconds else 0.,
+            1000 * end_seconds if end_seconds else 0.,
+            REL_PITCH)
+
+        return midi_contour.tobytes().translate(MIDI_MAP_TABLE).decode('ascii')
+
+
+@njit(cache=True)
+def quantise(starts, ends, pitches, quaver_duration, start_ms, end_ms,
+             rel_pitches):
+    """Compiled inner loop of MidiNoteReader.to_midi_contour.
+
+    All times are in milliseconds. A start_ms / end_ms of zero means the
+    range is unbounded on that side.
+    Returns the contour as an array of pitches looked up in rel_pitches."""
+
+    # Every note contributes at most ceil(duration / quaver) quavers, or
+    #   one quaver if it is shorter than that. Note on / off pairs from
+    #   different tracks can end before they start, giving a negative
+    #   duration.
+    max_len = 0
+    for i in range(len(starts)):
+        duration = ends[i] - starts[i]
+        max_len += max(0, int(duration / quaver_duration)) + 1
+
+    midi_contour = np.empty(max_len, dtype=np.int8)
+    fill = 0
+
+    music_time = 0.
+    output_time = 0.
+
+    for i in range(len(starts)):
+        start = starts[i]
+        end = ends[i]
+        duration = end - start
+
+        # Note occurs outwith range specified
+        if start_ms != 0 and end < start_ms:
+            music_time = end
+            output_time = end
+            continue
+        if end_ms != 0 and start > end_ms:
+            break
+        else:
+            music_time += duration
+
+        # If we're ahead, skip notes until we're back in sync
+        if music_time <= output_time:
+            continue
+
+        pitch = rel_pitches[pitches[i]]
+
+        rel_duration = duration / quaver_duration
+        if rel_duration == math.floor(rel_duration):
+            output_time += duration
+            num_quavers = int(rel_duration)
+        elif rel_duration < 1.0:
+            # In the output label everything is a quaver
+            output_time += quaver_duration
+            num_quavers = 1
+        else:
+            # If we've fallen behind, round up, else round down
+            if music_time > output_time:
+                num_quavers = int(math.ceil(rel_duration))
+            else:
+                num_quavers = int(math.floor(rel_duration))
+            output_time += num_quavers * quaver_duration
 
-        # Dummy quaver to compute duration of a single quaver at this tempo
-        #   Remember default midi quaver duration is 240 ms (TODO always?)
-        n = Note(0, 240, None)
-        n.set_tempo(tempo)
-        quaver_duration = n.duration
+        # A negative whole number of quavers adds nothing
+        if num_quavers > 0:
+            midi_contour[fill:fill + num_quavers] = pitch
+            fill += num_quavers
 
-        for _, note in enumerate(self._notes):
-            note.set_tempo(tempo)
+    return midi_contour[:fill]
 
-            # Note occurs outwith range specified
-            if start_seconds and note.end < 1000 * start_seconds:
-                music_time = note.end
-                output_time = note.end
-                continue
-            if end_seconds and note.start > 1000 * end_seconds:
-                break
-            else:
-                music_time += note.duration
 
-            # If we're ahead, skip notes until we're back in sync
-            if music_time <= output_time:
-                continue
+def parse_midi_notes(midi_bytes):
+    """Read the notes of a standard midi file into parallel arrays of
+    start times, end times and pitches.
 
-            rel_duration = (note.duration / quaver_duration)
-            if rel_duration.is_integer():
-                output_time += note.duration
-                midi_contour.extend([note.rel_pitch()] * int(rel_duration))
-            elif rel_duration < 1.0:
-                # In the output label everything is a quaver
-                output_time += quaver_duration
-                midi_contour.append(note.rel_pitch())
-            else:
-                # If we've fallen behind, round up, else round down
-                round_f = math.ceil if music_time > output_time else math.floor
-                rounded_int = round_f(rel_duration)
-                output_time += rounded_int * quaver_duration
-                midi_contour.extend([note.rel_pitch()] * rounded_int)
+    Note on / off events are paired up per pitch across all tracks, with
+    times in midi ticks from the start of each track."""
 
-        return ''.join(ff_config.MIDI_MAP[n] for n in midi_contour)
+    active_notes = {}
+    starts = array('i')
+    ends = array('i')
+    pitches = array('B')
 
+    pos = 0
+    while pos + 8 <= len(midi_bytes):
+        chunk_type = midi_bytes[pos:pos + 4]
+        chunk_len = int.from_bytes(midi_bytes[pos + 4:pos + 8], 'big')
+        pos += 8
+        chunk_end = pos + chunk_len
 
+        if chunk_type != b'MTrk':
+            pos = chunk_end
+            continue
 
-class Note:
-    def __init__(self, start, end, pitch):
-        """Store a single note.
+        time = 0
+        status = 0
 
-        All times are in milliseconds unless otherwise stated."""
-        self._midi_start = start
-        self._midi_end = end
-        self.pitch = pitch
+        while pos < chunk_end:
+            delta, pos = _read_varlen(midi_bytes, pos)
+            time += delta
 
-        self.start = self._midi_start
-        self.end = self._midi_end
+            if midi_bytes[pos] & 0x80:
+                status = midi_bytes[pos]
+                pos += 1
+            # Otherwise this is running status, reusing the last status byte
 
-    def set_tempo(self, tempo):
-        # Tempo specified in crotchet beats per minute
-        us_per_crotchet = 60000000. / tempo
+            if status == 0xFF:
+                # Meta event: type byte, then length-prefixed data
+                length, pos = _read_varlen(midi_bytes, pos + 1)
+                pos += length
+                continue
+            if status in (0xF0, 0xF7):
+                # System exclusive event
+                length, pos = _read_varlen(midi_bytes, pos)
+                pos += length
+                continue
 
-        # Beware that abc2midi does not adjust tempo by changing the times at
-        #   which notes start or end, but by (sensibly) passing the tempo to
-        #   the midi file itself which has a command to set the tempo, which
-        #   must be interpreted by whatever reads the midi file (eg fluidsynth
-        #   and this script).
+            event = status & 0xF0
+            if event in (0xC0, 0xD0):
+                pos += 1
+                continue
 
-        # This 480,000 comes from 125 bpm being the default tempo with the hard
-        #   coded midi times (240ms = 1 quaver => 480000us = 1 crotchet).
-        ms_scale_factor = us_per_crotchet / 480000
+            note = midi_bytes[pos]
+            pos += 2
 
-        self.start = ms_scale_factor * self._midi_start
-        self.end = ms_scale_factor * self._midi_end
+            if event == 0x90:
+                if note not in active_notes:
+                    active_notes[note] = time
+            elif event == 0x80:
+                if note not in active_notes:
+                    continue
 
-    @property
-    def duration(self):
-        return self.end - self.start
+                starts.append(active_notes.pop(note))
+                ends.append(time)
+                pitches.append(note)
 
-    def rel_pitch(self):
-        pitch = self.pitch
+        pos = chunk_end
 
-        # We use LTE / GTE here because we need an amount of frequency
-        #   content on both sides of the relevant pitch bin. See
-        #   comment on inclusive range in to_pseudo_spectrogram.
-        while pitch <= ff_config.MIDI_LOW:
-            pitch += 12
+    return starts, ends, pitches
 
-        while pitch >= ff_config.MIDI_HIGH:
-            pitch -= 12
 
-        return pitch - ff_config.MIDI_LOW
+def _read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
 
 
 def abc_to_midi(abc, midi_path, clean=True):
@@ -170,9 +259,4 @@ def abc_to_midi(abc, midi_path, clean=True):
         capture_output=True)
     stderr = captured.stderr.decode('utf-8')
     if stderr:
-        log.warning(stderr, file=sys.stderr)
-
-
-def midi_as_csv(midi_path):
-    midi_lines = py_midicsv.midi_to_csv(midi_path)
-    return [line.strip().replace(', ', ',') for line in midi_lines]
+        log.warning(stderr)
@@ -0,0 +1,106 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import midi  # noqa: E402
+
+
+def track(events):
+    return b'MTrk' + len(events).to_bytes(4, 'big') + events
+
+
+# Format 1 file with three tracks and 480 ticks per crotchet
+MIDI_BYTES = (
+    b'MThd\x00\x00\x00\x06\x00\x01\x00\x03\x01\xe0'
+    # Conductor track with only meta and sysex events
+    + track(
+        b'\x00\xff\x51\x03\x07\xa1\x20'  # Set tempo
+        b'\x00\xf0\x03\x7e\x7f\xf7'  # Sysex
+        b'\x00\xff\x01\x03abc'  # Text
+        b'\x00\xff\x2f\x00'  # End of track
+    )
+    + track(
+        b'\x00\xc0\x00'  # Program change, one data byte
+        b'\x00\xb0\x07\x64'  # Control change, two data bytes
+        b'\x00\x90\x48\x50'  # Note on 72 at 0
+        b'\x00\x4a\x50'  # Note on 74 at 0, running status
+        b'\x81\x70\x80\x48\x00'  # Note off 72 at 240
+        b'\x00\x4a\x00'  # Note off 74 at 240, running status
+        b'\x00\x90\x4c\x50'  # Note on 76 at 240
+        b'\x83\x60\x80\x4c\x00'  # Note off 76 at 720
+        b'\x00\xff\x2f\x00'
+    )
+    # Times start again from zero in each track
+    + track(
+        b'\x00\x90\x30\x50'  # Note on 48 at 0
+        b'\x78\x80\x30\x00'  # Note off 48 at 120
+        b'\x00\xff\x2f\x00'
+    )
+)
+
+
+class TestParseMidiNotes(unittest.TestCase):
+    def test_notes(self):
+        starts, ends, pitches = midi.parse_midi_notes(MIDI_BYTES)
+
+        self.assertEqual(list(starts), [0, 0, 240, 0])
+        self.assertEqual(list(ends), [240, 240, 720, 120])
+        self.assertEqual(list(pitches), [72, 74, 76, 48])
+
+    def test_empty(self):
+        starts, ends, pitches = midi.parse_midi_notes(b'')
+
+        self.assertEqual(len(starts), 0)
+        self.assertEqual(len(ends), 0)
+        self.assertEqual(len(pitches), 0)
+
+
+class TestMidiNoteReader(unittest.TestCase):
+    def test_to_midi_contour(self):
+        # One quaver each of 72 and 74, two quavers of 76, and the 48 is
+        #   folded up an octave and lengthened to a quaver.
+        contour = midi.MidiNoteReader(MIDI_BYTES).to_midi_contour()
+        self.assertEqual(contour, 'yACCm')
+
+    def test_empty(self):
+        self.assertEqual(midi.MidiNoteReader(b'').to_midi_contour(), '')
+
+    def test_negative_durations(self):
+        # Note on / off events are paired across tracks, so a note off in a
+        #   later track can come before its note on. Such a note is never
+        #   reached by the music, so adds nothing to the contour.
+        midi_bytes = (
+            b'MThd\x00\x00\x00\x06\x00\x01\x00\x02\x01\xe0'
+            + track(
+                b'\x00\x90\x48\x50'  # Note on 72 at 0
+                b'\x83\x60\x80\x48\x00'  # Note off 72 at 480
+                b'\xa7\x08\x90\x4a\x50'  # Note on 74 at 5000
+                b'\x00\xff\x2f\x00'
+            )
+            + track(
+                b'\x9f\x48\x80\x4a\x00'  # Note off 74 at 4040
+                b'\x00\xff\x2f\x00'
+            )
+        )
+        contour = midi.MidiNoteReader(midi_bytes).to_midi_contour()
+        self.assertEqual(contour, 'yy')
+
+    def test_only_negative_duration(self):
+        midi_bytes = (
+            b'MThd\x00\x00\x00\x06\x00\x01\x00\x02\x01\xe0'
+            + track(
+                b'\xce\x10\x90\x48\x50'  # Note on 72 at 10000
+                b'\x00\xff\x2f\x00'
+            )
+            + track(
+                b'\x00\x80\x48\x00'  # Note off 72 at 0
+                b'\x00\xff\x2f\x00'
+            )
+        )
+        contour = midi.MidiNoteReader(midi_bytes).to_midi_contour()
+        self.assertEqual(contour, '')
+
+if __name__ == '__main__':
+    unittest.main()